@@ -1,84 +1,239 @@
 import logging
 import pandas as pd
 import os
-from openai import OpenAI
+import asyncio
+import json
+import random
 import time
+from openai import AsyncOpenAI, RateLimitError
+from llm_cache import LLMCache
+from utils import export_parquet
 
-def authenticate_OpenAI():
-    """Authenticate the OpenAI client."""
-    global client
-    key = os.getenv("OPENAI_API_KEY")
-    if not key:
-        raise EnvironmentError("Missing OPENAI_API_KEY.")
-    client = OpenAI(api_key=key)
-    print(client.models.list())  # Test the connection
-    logging.info("OpenAI authenticated.")
+# Maximum number of ChatGPT requests in flight at once
+MAX_CONCURRENT_REQUESTS = 20
+# Account rate limits; tokens per minute is only enforced when set
+MAX_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_MAX_REQUESTS_PER_MINUTE", 3500))
+MAX_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_MAX_TOKENS_PER_MINUTE", 0)) or None
+# Upper bound for a single rate-limit backoff
+MAX_BACKOFF_SEC = 60
+# Rough allowance for the completion when estimating tokens per request
+COMPLETION_TOKEN_ESTIMATE = 500
 
-def evaluate_sites_with_chatgpt(sites_df, model_name, advice_csv):
-    global client
-
-    if sites_df.empty:
-        logging.warning('No sites to evaluate.')
-        return sites_df
+# Number of sites packed into a single ChatGPT request
+BATCH_SIZE = 10
 
-    # ensure authenticated
-    if client is None:
-        authenticate_OpenAI()
-
-    logging.info(f"Evaluating {len(sites_df)} sites with {model_name}...")
-    advice_list = []
-    for idx, row in sites_df.iterrows():
-        prompt = f"""
-Site {idx+1}:
-  - Mean NDVI: {row['mean_ndvi']:.3f}
-  - Mean Elevation: {row['mean_elev']:.1f} m
-  - Compactness: {row['compactness']:.3f}
+METRICS_TEMPLATE = """  - Mean NDVI: {ndvi:.3f}
+  - Mean Elevation: {elev:.1f} m
+  - Compactness: {comp:.3f}
+"""
 
-You are an expert in archaeology and remote sensing. Based on the above metrics for a site within the Amazon region, evaluate its potential as an archaeological site.
+PROMPT_TEMPLATE = """
+{sites}
+You are an expert in archaeology and remote sensing. Based on the above metrics for each site within the Amazon region, evaluate its potential as an archaeological site.
 
-Please:
+For each site:
   1. Provide your reasoning based on elevation, NDVI, and compactness.
   2. Rate the site's archaeological potential on a scale of 1 to 10 (1 = very unlikely, 10 = highly likely).
   3. Give a brief summary of key considerations.
+
+Respond with a JSON object of the form
+{{"evaluations": [{{"site": <site number>, "reasoning": "...", "rating": <1-10>, "summary": "..."}}]}}
+containing exactly one entry per site.
 """
-        # retry loop for rate limits (no import of missing submodule)
+
+class RateLimiter:
+    """
+    Token-bucket limiter that spaces requests out to stay under the
+    requests-per-minute (and optionally tokens-per-minute) limits,
+    instead of bursting until the API answers with 429.
+    """
+    def __init__(self, rpm, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm) if tpm else 0.0
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens=0):
+        """Wait until one request (and `tokens` tokens) fit in the budget."""
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self._requests < 1:
+                    wait = (1 - self._requests) * 60 / self.rpm
+                if self.tpm and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+def _retry_after(err):
+    """Return the Retry-After delay in seconds from a rate-limit error, if any."""
+    response = getattr(err, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def authenticate_OpenAI():
+    """
+    Create an OpenAI client. Its connection pool is bound to the running
+    event loop, so create it inside the loop that uses it.
+    """
+    key = os.getenv("OPENAI_API_KEY")
+    if not key:
+        raise EnvironmentError("Missing OPENAI_API_KEY.")
+    logging.info("OpenAI authenticated.")
+    return AsyncOpenAI(api_key=key)
+
+def _parse_evaluations(content, n_sites):
+    """
+    Turn a batch response into one advice string per site, in order.
+    Raises ValueError if the response is malformed or does not cover
+    exactly sites 1..n_sites.
+    """
+    try:
+        evaluations = json.loads(content)['evaluations']
+        by_site = {int(e['site']): e for e in evaluations}
+        if len(evaluations) != n_sites or set(by_site) != set(range(1, n_sites + 1)):
+            raise ValueError(f"expected sites 1..{n_sites}, got {sorted(by_site)}")
+        advice = []
+        for n in range(1, n_sites + 1):
+            e = by_site[n]
+            advice.append(
+                f"Rating: {e['rating']}/10\n"
+                f"Reasoning: {e['reasoning']}\n"
+                f"Summary: {e['summary']}"
+            )
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Malformed evaluations: {e}") from e
+    return advice
+
+async def _evaluate_batch(client, batch, labels, model_name, sem, limiter, cache):
+    """
+    Request advice for a batch of unique site metrics in one call, holding a
+    slot of the semaphore. `labels` are the site numbers used for logging.
+    """
+    label = ', '.join(labels)
+    sites = '\n'.join(f"Site {n}:\n{metrics}" for n, metrics in enumerate(batch, start=1))
+    prompt = PROMPT_TEMPLATE.format(sites=sites)
+    messages = [{'role': 'user', 'content': prompt}]
+    # ~4 characters per token is close enough for budgeting
+    estimated_tokens = len(prompt) // 4 + COMPLETION_TOKEN_ESTIMATE * len(batch)
+    async with sem:
+        cached = cache.get(model_name, messages)
+        if cached is not None:
+            try:
+                advice = _parse_evaluations(cached, len(batch))
+                logging.info(f"Sites {label} advice served from cache.")
+                return advice
+            except ValueError:
+                pass
+        attempt = 0
         while True:
+            await limiter.acquire(estimated_tokens)
             try:
-                response = client.chat.completions.create(
+                response = await client.chat.completions.create(
                     model=model_name,
-                    messages=[{'role': 'user', 'content': prompt}]
+                    messages=messages,
+                    response_format={'type': 'json_object'}
                 )
-                advice_text = response.choices[0].message.content.strip()
+                content = response.choices[0].message.content
+                advice = _parse_evaluations(content, len(batch))
+                cache.set(model_name, messages, content)
                 break
+            except RateLimitError as e:
+                # exponential backoff with jitter, unless the server tells us how long
+                backoff_sec = _retry_after(e) or min(MAX_BACKOFF_SEC, 2 ** attempt + random.random())
+                attempt += 1
+                logging.warning(f"Rate limit hit for sites {label}. Retrying in {backoff_sec:.1f}s...")
+                await asyncio.sleep(backoff_sec)
             except Exception as e:
-                err_str = str(e).lower()
-                if 'rate limit' in err_str or '429' in err_str:
-                    backoff_sec = 5
-                    logging.warning(f"Rate limit hit. Retrying in {backoff_sec}s...")
-                    time.sleep(backoff_sec)
-                    continue
-                else:
-                    logging.error(f"Failed ChatGPT for site {idx+1}: {e}")
-                    advice_text = '<error>'
-                    break
-        advice_list.append(advice_text)
-        logging.info(f"Site {idx+1} advice received.")
+                logging.error(f"Failed ChatGPT for sites {label}: {e}")
+                advice = ['<error>'] * len(batch)
+                break
+    logging.info(f"Sites {label} advice received.")
+    return advice
+
+async def _gather_all(sites_df, model_name):
+    """
+    Evaluate all sites concurrently, packing up to BATCH_SIZE unique sets of
+    metrics into each request. Results keep the order of sites_df.
+    """
+    # Format every site's metrics up front from the raw column arrays
+    metrics = [
+        METRICS_TEMPLATE.format(ndvi=n, elev=e, comp=c)
+        for n, e, c in zip(sites_df['mean_ndvi'].to_numpy(),
+                           sites_df['mean_elev'].to_numpy(),
+                           sites_df['compactness'].to_numpy())
+    ]
+    # Sites whose rounded metrics match only need to be asked about once
+    groups = {}
+    for idx, m in zip(sites_df.index, metrics):
+        groups.setdefault(m, []).append(str(idx + 1))
+    unique = list(groups)
+    batches = [unique[i:i + BATCH_SIZE] for i in range(0, len(unique), BATCH_SIZE)]
+    logging.info(f"{len(unique)} unique sites for {len(metrics)} sites, "
+                 f"in {len(batches)} requests.")
+
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+    async with authenticate_OpenAI() as client:
+        cache = LLMCache()
+        try:
+            results = await asyncio.gather(*[
+                _evaluate_batch(client, batch, ['/'.join(groups[m]) for m in batch],
+                                model_name, sem, limiter, cache)
+                for batch in batches
+            ])
+        finally:
+            cache.close()
+    advice_by_metrics = {}
+    for batch, advice in zip(batches, results):
+        advice_by_metrics.update(zip(batch, advice))
+    return [advice_by_metrics[m] for m in metrics]
+
+def evaluate_sites_with_chatgpt(sites_df, model_name, advice_csv):
+    if sites_df.empty:
+        logging.warning('No sites to evaluate.')
+        return sites_df
+
+    logging.info(f"Evaluating {len(sites_df)} sites with {model_name}...")
+    advice_list = asyncio.run(_gather_all(sites_df, model_name))
+    for idx, advice_text in zip(sites_df.index, advice_list):
         print(f"Site {idx+1} advice: {advice_text}")
 
     sites_df['advice'] = advice_list
     sites_df.to_csv(advice_csv, index=False)
+    export_parquet(sites_df, advice_csv)
     logging.info(f"Exported advice to {advice_csv}.")
     return sites_df
 
 if __name__ == "__main__":
 
-    client = None
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     
     MODEL_NAME = "gpt-4o-mini"
     ADVICE_CSV = "site_advice.csv"
     TOP_CSV = "top25_sites.csv"
-    df = pd.read_csv(TOP_CSV)
+    df = pd.read_csv(TOP_CSV, engine='pyarrow')
     
     evaluate_sites_with_chatgpt(df, model_name=MODEL_NAME, advice_csv=ADVICE_CSV)
-    logging.info("Site evaluation completed.")
\ No newline at end of file
+    logging.info("Site evaluation completed.")
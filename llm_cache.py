@@ -0,0 +1,54 @@
+"""
+llm_cache.py
+
+Persistent cache for ChatGPT responses:
+- Entries are looked up by a SHA-256 hash of the model and messages
+- Entries are stored in a local SQLite database
+
+Only exact repeats are served. Site prompts differ only in their metric
+values, so a similar-looking prompt is a different set of sites.
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+
+# Configuration
+CACHE_PATH = os.path.join("data", "llm_cache.sqlite")
+
+class LLMCache:
+    """Cache of chat completion responses keyed on the exact request."""
+    def __init__(self, path=CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT)"
+        )
+        self.conn.commit()
+        count = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        logging.info(f"LLM cache opened with {count} entries at {path}.")
+
+    @staticmethod
+    def _key(model, messages):
+        payload = json.dumps({"model": model, "messages": messages}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model, messages):
+        """Return the cached response for the request, or None on a miss."""
+        row = self.conn.execute(
+            "SELECT response FROM cache WHERE key = ?", (self._key(model, messages),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, model, messages, response):
+        """Store a response for the request."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, model, response) VALUES (?, ?, ?)",
+            (self._key(model, messages), model, response)
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -8,6 +8,9 @@ def main():
 
     MODEL_NAME = "gpt-4o-mini"
     ADVICE_CSV = "site_advice.csv"
+    # Stages hand DataFrames to each other in memory; set to also write
+    # every intermediate CSV for debugging
+    SAVE_INTERMEDIATE = False
 
     aoi = [
         [-64, -10],
@@ -16,17 +19,17 @@ def main():
         [-64,   0]
     ]
 
-    possible_sites = select_possible_site(aoi)
+    possible_sites = select_possible_site(aoi, export=SAVE_INTERMEDIATE)
 
     # Print the results
     print("Possible sites selected:")
     for site in possible_sites:
         print(site)
     
-    subregions_df = export_subregions()
+    subregions_df = export_subregions(sites=possible_sites, export=SAVE_INTERMEDIATE)
     logging.info(f"Subregions created with {len(subregions_df)} entries.")
 
-    final_sites = process_sites()
+    final_sites = process_sites(df=subregions_df, export=SAVE_INTERMEDIATE)
     logging.info(f"Processed sites with {len(final_sites)} entries.")
 
     logging.info(f"Final sites exported: {len(final_sites)} sites.")
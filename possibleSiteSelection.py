@@ -4,7 +4,11 @@ import os
 import logging
 import sys
 import csv
-import json
+import time
+import random
+import orjson
+from shapely.geometry import Polygon, box, mapping
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(
@@ -15,26 +19,33 @@ logging.basicConfig(
 
 client = None
 
+# High-volume endpoint is intended for many concurrent automated requests
+HIGH_VOLUME_URL = 'https://earthengine-highvolume.googleapis.com'
+# Attempts per request when Earth Engine rate-limits us
+MAX_RETRIES = 5
+
 def authenticate_earth_engine(project_id=None):
     """Authenticate and initialize the Earth Engine API."""
     proj = project_id or os.getenv("EARTHENGINE_PROJECT")
     if not proj:
         raise RuntimeError("Set EARTHENGINE_PROJECT or pass project_id.")
     ee.Authenticate()
-    ee.Initialize(project=proj)
+    ee.Initialize(project=proj, opt_url=HIGH_VOLUME_URL)
     logging.info(f"Earth Engine initialized with project: {proj}")
 
 def split_aoi(aoi, tile_size_deg=0.5):
     """
-    Split a polygon AOI into a grid of smaller tiles (in degrees).
-    Uses zero tolerance for intersection to avoid reprojection errors.
-    Returns a list of ee.Geometry.Polygon tiles.
+    Split a polygon AOI (list of [lon, lat] vertices) into a grid of
+    smaller tiles (in degrees).
+    Bounds and intersections are computed locally: an axis-aligned
+    rectangular AOI needs no intersection at all, and irregular AOIs are
+    clipped with shapely instead of adding an intersection node per tile.
+    Returns a list of ee.Geometry tiles.
     """
-    coords = aoi.bounds().getInfo()['coordinates'][0]
-    lons = [p[0] for p in coords]
-    lats = [p[1] for p in coords]
-    min_lon, max_lon = min(lons), max(lons)
-    min_lat, max_lat = min(lats), max(lats)
+    aoi_poly = Polygon(aoi)
+    min_lon, min_lat, max_lon, max_lat = aoi_poly.bounds
+    # only an AOI that fills its own bounding box can skip clipping
+    is_rectangle = aoi_poly.equals(aoi_poly.envelope)
 
     tiles = []
     lon = min_lon
@@ -43,35 +54,50 @@ def split_aoi(aoi, tile_size_deg=0.5):
         lat = min_lat
         while lat < max_lat:
             next_lat = min(lat + tile_size_deg, max_lat)
-            tile = ee.Geometry.Polygon([
-                [lon, lat],
-                [next_lon, lat],
-                [next_lon, next_lat],
-                [lon, next_lat]
-            ])
-            # zero maxError avoids tiny reprojection tolerance errors
-            tiles.append(tile.intersection(aoi, 0))
+            if is_rectangle:
+                tiles.append(ee.Geometry.Polygon([
+                    [lon, lat],
+                    [next_lon, lat],
+                    [next_lon, next_lat],
+                    [lon, next_lat]
+                ]))
+            else:
+                inter = aoi_poly.intersection(box(lon, lat, next_lon, next_lat))
+                # skip tiles outside the AOI or touching it only along an edge
+                if inter.area > 0:
+                    tiles.append(ee.Geometry(mapping(inter)))
             lat = next_lat
         lon = next_lon
 
     logging.info(f"Split AOI into {len(tiles)} tiles of ~{tile_size_deg}°")
     return tiles
 
-def detect_in_tile(tile, collection, dem, ndvi_thresh, elev_thresh, min_area,
-                   vec_scale=100, tile_scale=4):
+def detect_in_tile(tile, median_img, dem, ndvi_thresh, elev_thresh, min_area,
+                   vec_scale=100, tile_scale=4, stats_tile_scale=16):
     """
     Process one tile: compute NDVI, mask, vectorize with tileScale, then
-    compute per-feature stats and filter by area.
+    filter by area and compute per-feature stats with stats_tile_scale.
+    median_img is the AOI-wide composite shared by all tiles; no clipping is
+    needed since every reduction is bounded by the tile or feature geometry.
     Returns a list of features as dicts.
     """
-    comp = collection.median().clip(tile)
-    ndvi = comp.normalizedDifference(['B8', 'B4']).rename('NDVI')
-    dem_clip = dem.select('elevation').clip(tile)
+    ndvi = median_img.normalizedDifference(['B8', 'B4']).rename('NDVI')
+    elev = dem.select('elevation')
+
+    # Aggregate to the vectorization scale first so the mask is evaluated on
+    # vec_scale pixels instead of native 10 m / 30 m ones.
+    ndvi_ds = (ndvi
+               .reduceResolution(ee.Reducer.mean(), bestEffort=True)
+               .reproject(crs='EPSG:4326', scale=vec_scale))
+    dem_ds = (elev
+              .reduceResolution(ee.Reducer.mean(), bestEffort=True)
+              .reproject(crs='EPSG:4326', scale=vec_scale))
 
-    mask = ndvi.lt(ndvi_thresh).And(dem_clip.gt(elev_thresh)).selfMask()
+    mask = ndvi_ds.lt(ndvi_thresh).And(dem_ds.gt(elev_thresh)).selfMask()
 
     vectors = mask.reduceToVectors(
         geometry=tile,
+        crs='EPSG:4326',
         scale=vec_scale,
         maxPixels=1e13,
         tileScale=tile_scale,
@@ -80,34 +106,79 @@ def detect_in_tile(tile, collection, dem, ndvi_thresh, elev_thresh, min_area,
         eightConnected=False
     )
 
-    raw_count = vectors.size().getInfo()
-    logging.info(f"  raw vectors in tile: {raw_count}")
+    def add_shape(feat):
+        # geodesic shape metrics in metres, computed server-side
+        geom = feat.geometry()
+        area = geom.area(1)
+        perimeter = geom.perimeter(1)
+        return feat.set({
+            'area_m2': area,
+            'perimeter': perimeter,
+            'compactness': perimeter.divide(area.sqrt())
+        })
 
     def add_stats(feat):
-        stats = ndvi.addBands(dem_clip).reduceRegion(
-            reducer=ee.Reducer.mean(),
+        # polygons come from vectorizing at vec_scale, so pixel weights are
+        # unnecessary; a higher tileScale avoids user memory limit errors
+        stats = ndvi.addBands(elev).reduceRegion(
+            reducer=ee.Reducer.mean().unweighted(),
             geometry=feat.geometry(),
             scale=vec_scale,
             maxPixels=1e13,
-            tileScale=tile_scale
+            tileScale=stats_tile_scale
         )
         return feat.set({
             'mean_ndvi': stats.get('NDVI'),
-            'mean_elev': stats.get('elevation'),
-            'area_m2': feat.geometry().area(1)
+            'mean_elev': stats.get('elevation')
         })
 
-    stats_fc = vectors.map(add_stats)
-    filtered = stats_fc.filter(ee.Filter.gt('area_m2', min_area))
+    # Filter by area before the per-feature reductions so small polygons
+    # never pay for a reduceRegion
+    filtered = (vectors.map(add_shape)
+                .filter(ee.Filter.gt('area_m2', min_area))
+                .map(add_stats))
 
-    info = filtered.getInfo()
-    results = []
-    for f in info.get('features', []):
-        results.append({
-            'geometry': f['geometry'],
-            'properties': f['properties']
-        })
-    return results
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        # diagnostic only, so it costs an extra round-trip just in debug runs
+        logging.debug(f"  raw vectors in tile: {vectors.size().getInfo()}")
+
+    return [
+        {'geometry': f['geometry'], 'properties': f['properties']}
+        for f in with_retry(lambda: fetch_features(filtered))
+    ]
+
+def fetch_features(fc, page_size=1000):
+    """
+    Fetch a FeatureCollection page by page with ee.data.computeFeatures,
+    rather than one monolithic getInfo response for the whole collection.
+    Returns the list of GeoJSON feature dicts.
+    """
+    features = []
+    params = {'expression': fc, 'pageSize': page_size}
+    while True:
+        resp = ee.data.computeFeatures(params)
+        features.extend(resp.get('features', []))
+        token = resp.get('nextPageToken')
+        if not token:
+            return features
+        params['pageToken'] = token
+
+def with_retry(fetch):
+    """
+    Call fetch(), retrying with exponential backoff when Earth Engine
+    rate-limits us.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return fetch()
+        except ee.EEException as e:
+            err_str = str(e).lower()
+            rate_limited = '429' in err_str or 'too many requests' in err_str
+            if not rate_limited or attempt == MAX_RETRIES - 1:
+                raise
+            backoff_sec = 2 ** attempt + random.random()
+            logging.warning(f"Earth Engine rate limit hit. Retrying in {backoff_sec:.1f}s...")
+            time.sleep(backoff_sec)
 
 def export_sites_to_csv(sites, path='candidate_sites.csv'):
     """
@@ -120,22 +191,25 @@ def export_sites_to_csv(sites, path='candidate_sites.csv'):
         return
 
     # Determine all property names (in case they vary)
-    props = sorted({k for s in sites for k in s['properties'].keys()})
+    props = sorted({k for s in sites for k in s['properties']})
+    # Flatten every row up front so the writer can emit them in one call
+    rows = [
+        [orjson.dumps(s['geometry']).decode()] + [s['properties'].get(p) for p in props]
+        for s in sites
+    ]
 
-    with open(path, 'w', newline='') as f:
+    with open(path, 'w', newline='', buffering=1 << 20) as f:
         writer = csv.writer(f)
-        # Header
         writer.writerow(['geometry'] + props)
-        # Rows
-        for s in sites:
-            geom = s['geometry']  # a dict
-            geom_str = json.dumps(geom)
-            row = [geom_str] + [s['properties'].get(p) for p in props]
-            writer.writerow(row)
+        writer.writerows(rows)
 
     print(f"Wrote {len(sites)} sites to {path}")
 
-def select_possible_site(aoi):
+def select_possible_site(aoi, export=True):
+    """
+    Detect candidate sites over the AOI and return them as a list of
+    {'geometry', 'properties'} dicts; also written to CSV when export is set.
+    """
     authenticate_earth_engine()
 
     # User parameters
@@ -145,6 +219,7 @@ def select_possible_site(aoi):
     min_area      = 10_000   # in m²
     vec_scale     = 1000      # meters per pixel for vectorization
     tile_scale    = 4        # internal aggregation factor
+    max_workers   = 25       # concurrent tile requests to Earth Engine
 
     # Define your Amazon AOI
     amazon = ee.Geometry.Polygon(aoi)
@@ -157,25 +232,40 @@ def select_possible_site(aoi):
         .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 10))
     )
     dem = ee.Image('USGS/SRTMGL1_003')
+    # One composite for the whole AOI so tiles share a single median node.
+    # The median has no native projection, so borrow Sentinel-2's for
+    # the reduceResolution step in detect_in_tile.
+    median_img = collection.median().setDefaultProjection(
+        collection.first().select('B8').projection()
+    )
 
-    tiles = split_aoi(amazon, tile_size_deg)
+    tiles = split_aoi(aoi, tile_size_deg)
     all_sites = []
 
-    for idx, tile in enumerate(tiles, start=1):
-        logging.info(f"Processing tile {idx}/{len(tiles)}...")
-        try:
-            sites = detect_in_tile(
-                tile, collection, dem,
+    # Tiles are independent and network-bound, so run them concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = [
+            ex.submit(
+                detect_in_tile,
+                tile, median_img, dem,
                 ndvi_thresh, elev_thresh, min_area,
                 vec_scale, tile_scale
             )
-            logging.info(f"Tile {idx}: found {len(sites)} sites")
-            all_sites.extend(sites)
-        except Exception as e:
-            logging.warning(f"Tile {idx} failed: {e}")
+            for tile in tiles
+        ]
+        logging.info(f"Processing {len(tiles)} tiles with {max_workers} workers...")
+        # Collect in tile order so the candidate order is the same every run
+        for idx, future in enumerate(futures, start=1):
+            try:
+                sites = future.result()
+                logging.info(f"Tile {idx}: found {len(sites)} sites")
+                all_sites.extend(sites)
+            except Exception as e:
+                logging.warning(f"Tile {idx} failed: {e}")
 
     logging.info(f"Total candidate sites: {len(all_sites)}")
 
-    export_sites_to_csv(all_sites, "candidate_sites.csv")
+    if export:
+        export_sites_to_csv(all_sites, "candidate_sites.csv")
 
     return all_sites
@@ -10,13 +10,12 @@ Enhancements:
 - Exports top K candidates
 """
 import os
-import json
 import logging
 import pandas as pd
 import numpy as np
-from shapely.geometry import shape
-from shapely.ops import transform
+import shapely
 from pyproj import Transformer
+from utils import export_parquet, top_k_indices, transform_geoms
 
 # -------------------------------------------
 # Configuration
@@ -30,6 +29,8 @@ WEIGHTS = {
     'mean_elev':  1.0,   # higher elevation more likely
     'compactness': 1.0   # more compact shapes preferred
 }
+# Built once at import; CRS lookup is the expensive part of a Transformer
+_TRANSFORMER = Transformer.from_crs('EPSG:4326', 'EPSG:3857', always_xy=True)
 
 # -------------------------------------------
 # Logging setup
@@ -38,55 +39,63 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s %(levelname)s %(message)s'
 )
-logging = logging.getlogging(__name__)
+logging = logging.getLogger(__name__)
 
 # -------------------------------------------
 # Main processing function
 # -------------------------------------------
-def process_sites():
+def process_sites(df=None, export=True):
+    """
+    Score subregions and return the top K. `df` is the DataFrame returned
+    by export_subregions; when omitted, subregions are read from INPUT_CSV.
+    """
     # 1. Load data
-    logging.info(f"Loading subregions from {INPUT_CSV}...")
-    df = pd.read_csv(INPUT_CSV)
+    if df is None:
+        logging.info(f"Loading subregions from {INPUT_CSV}...")
+        df = pd.read_csv(INPUT_CSV, engine='pyarrow')
     logging.info(f"Loaded {len(df)} subregions.")
 
-    # 2. Parse geometries
+    # 2. Parse geometries (one vectorized GEOS call for all rows)
     logging.info("Parsing GeoJSON geometries...")
-    df['geometry_obj'] = df['geometry'].apply(lambda g: shape(json.loads(g)))
+    geoms = shapely.from_geojson(df['geometry'].to_numpy())
 
-    # 3. Project to metric CRS
+    # 3. Project to metric CRS, transforming all coordinates in one batch
     logging.info("Projecting geometries to EPSG:3857...")
-    transformer = Transformer.from_crs('EPSG:4326', 'EPSG:3857', always_xy=True)
-    df['geom_proj'] = df['geometry_obj'].apply(lambda geom: transform(transformer.transform, geom))
+    geoms_proj = transform_geoms(_TRANSFORMER, geoms)
 
     # 4. Compute shape metrics
     logging.info("Computing area and perimeter...")
-    df['area_m2'] = df['geom_proj'].apply(lambda g: g.area)
-    df['perimeter'] = df['geom_proj'].apply(lambda g: g.length)
+    df['area_m2'] = shapely.area(geoms_proj)
+    df['perimeter'] = shapely.length(geoms_proj)
 
     logging.info("Computing compactness (perimeter / sqrt(area))...")
     df['compactness'] = df['perimeter'] / np.sqrt(df['area_m2'])
 
     # 5. Normalize metrics and compute composite score
     logging.info("Normalizing metrics and computing composite score...")
-    for metric, weight in WEIGHTS.items():
+    for metric in WEIGHTS:
         if metric not in df.columns:
             logging.error(f"Metric '{metric}' not found in DataFrame.")
             return
-        zcol = f"{metric}_z"
-        df[zcol] = (df[metric] - df[metric].mean()) / df[metric].std(ddof=0)
-    df['score'] = sum(df[f"{m}_z"] * w for m, w in WEIGHTS.items())
+    M = df[list(WEIGHTS)].to_numpy(dtype=np.float64)
+    # skip missing values like pandas' mean/std, so one NaN only drops its own row
+    Z = (M - np.nanmean(M, axis=0)) / np.nanstd(M, axis=0)
+    w = np.array(list(WEIGHTS.values()))
+    # keep the per-metric z-scores in the export
+    df[[f"{m}_z" for m in WEIGHTS]] = Z
+    df['score'] = Z @ w
     logging.info("Composite scores computed.")
 
     # 6. Select top K candidates
     logging.info(f"Selecting top {TOP_K} sites by score...")
-    top_df = df.nlargest(TOP_K, 'score').copy()
+    top_df = df.iloc[top_k_indices(df['score'].to_numpy(), TOP_K)].copy()
     logging.info(f"Selected {len(top_df)} sites.")
 
     # 7. Export results
-    cols_to_drop = ['geometry_obj', 'geom_proj']
-    top_df = top_df.drop(columns=cols_to_drop, errors='ignore')
-    logging.info(f"Exporting top {len(top_df)} sites to {OUTPUT_CSV}...")
-    top_df.to_csv(OUTPUT_CSV, index=False)
+    if export:
+        logging.info(f"Exporting top {len(top_df)} sites to {OUTPUT_CSV}...")
+        top_df.to_csv(OUTPUT_CSV, index=False)
+        export_parquet(top_df, OUTPUT_CSV)
     logging.info("Process complete.")
 
     return top_df
@@ -8,25 +8,41 @@ Cleaned end-to-end pipeline with top-N selection:
 3. Subdivide all sites into 100m×100m cells
 4. Build combined NDVI+DEM image
 5. Bulk compute NDVI/elevation for all subcells
-6. Load results into pandas and compute anomaly scores
+6. Fetch per-subcell NDVI/elevation (no geometry) and compute anomaly scores
 7. Select top 300 most anomalous subregions
 8. Export
 9. Detailed logging
 """
 import os
-import json
+import itertools
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import hashlib
 import numpy as np
 import ee
 import logging
-from shapely.geometry import shape, mapping, box
-from possibleSiteSelection import authenticate_earth_engine
+import shapely
+from shapely.geometry import shape
+from pyproj import Transformer
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from possibleSiteSelection import authenticate_earth_engine, fetch_features, with_retry
+from utils import export_parquet, top_k_indices, transform_geoms
 
 # Configuration
 INPUT_CSV = os.path.expanduser("~/Desktop/OpenAiToZ/candidate_sites.csv")
 CELL_SIZE = 100.0  # meters
 OUTPUT_CSV = os.path.expanduser("~/Desktop/OpenAiToZ/subregions_evaluated.csv")
+# Subdivided cells are cached here and reused while the candidates are unchanged
+SUBCELLS_PARQUET = os.path.expanduser("~/Desktop/OpenAiToZ/subcells.parquet")
 TOP_K = 300
+REDUCE_CHUNK_SIZE = 500  # subcells per reduceRegions request
+MAX_WORKERS = 16         # concurrent reduceRegions requests
+SUBDIVIDE_CHUNKSIZE = 64 # sites handed to a worker process at a time
+PARALLEL_MIN_SITES = 512 # fewer sites are subdivided in-process
 
 # Logging
 logging.basicConfig(level=logging.INFO,
@@ -34,17 +50,154 @@ logging.basicConfig(level=logging.INFO,
 
 # Subdivide geometry into grid cells
 def subdivide_geometry(geom, size):
+    """
+    Clip geom to a grid of size×size cells, built and intersected as
+    shapely arrays. Cells not touching geom are dropped and cells inside
+    it are kept whole. Returns an ndarray of geometries.
+    """
     minx, miny, maxx, maxy = geom.bounds
+    # A site no larger than one cell is its own single subcell
+    if maxx - minx <= size and maxy - miny <= size:
+        return np.array([geom], dtype=object)
     xs = np.arange(minx, maxx, size)
     ys = np.arange(miny, maxy, size)
-    cells = []
-    for x in xs:
-        for y in ys:
-            cell = box(x, y, x + size, y + size)
-            inter = geom.intersection(cell)
-            if not inter.is_empty:
-                cells.append(inter)
-    return cells
+    # flat lower-left corner buffers in x-major order, without the 2-D
+    # meshgrid temporaries
+    x0 = np.repeat(xs, len(ys))
+    y0 = np.tile(ys, len(xs))
+    cells = shapely.box(x0, y0, x0 + size, y0 + size)
+    # Prepared geometry makes the predicates cheap; only boundary cells
+    # need a real intersection, interior cells are kept as-is
+    shapely.prepare(geom)
+    inside = shapely.contains_properly(geom, cells)
+    touch = shapely.intersects(geom, cells) & ~inside
+    result = cells.copy()
+    result[touch] = shapely.intersection(geom, cells[touch])
+    keep = inside | (touch & ~shapely.is_empty(result))
+    return result[keep]
+
+@lru_cache(maxsize=None)
+def utm_transformers(epsg):
+    """Forward (WGS84 -> UTM) and inverse transformers for a UTM zone, built once."""
+    return (Transformer.from_crs('EPSG:4326', f'EPSG:{epsg}', always_xy=True),
+            Transformer.from_crs(f'EPSG:{epsg}', 'EPSG:4326', always_xy=True))
+
+def utm_epsg(lon, lat):
+    """EPSG code of the WGS84 UTM zone containing (lon, lat)."""
+    zone = int((lon + 180) // 6) + 1
+    return (32600 if lat >= 0 else 32700) + zone
+
+def subdivide_site(geom, size):
+    """
+    Subdivide a WGS84 geometry into size×size metre cells by gridding it in
+    its local UTM zone. Returns the cells as WGS84 geometries.
+    """
+    centroid = geom.centroid
+    fwd, inv = utm_transformers(utm_epsg(centroid.x, centroid.y))
+    cells = subdivide_geometry(transform_geoms(fwd, geom), size)
+    return transform_geoms(inv, cells)
+
+def subdivide_site_wkb(wkb, size):
+    """
+    subdivide_site for worker processes: WKB in and out, which pickles far
+    cheaper than shapely geometries.
+    """
+    return shapely.to_wkb(subdivide_site(shapely.from_wkb(wkb), size))
+
+def hilbert_distance(x, y, level=16):
+    """
+    Position of each point along a Hilbert curve laid over the points'
+    bounding box on a 2**level × 2**level grid.
+    """
+    n = 1 << level
+
+    def to_grid(v):
+        span = v.max() - v.min()
+        if span == 0:
+            return np.zeros(len(v), dtype=np.int64)
+        return ((v - v.min()) / span * (n - 1)).astype(np.int64)
+
+    x, y = to_grid(x), to_grid(y)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return d
+
+def subdivide_sites(geoms, cache=True):
+    """
+    Subdivide every site geometry into CELL_SIZE cells.
+    Returns (site_pos, subcell_id, cells) arrays, where site_pos is the
+    position of the source site in geoms. Cells are sorted along a Hilbert
+    curve so consecutive chunks are spatially compact. With cache set they
+    are cached in SUBCELLS_PARQUET keyed on the input geometries and
+    CELL_SIZE; the cache is best-effort and never fails the run.
+    """
+    wkb = shapely.to_wkb(geoms)
+    fingerprint = hashlib.sha256(
+        b''.join(wkb) + str(CELL_SIZE).encode()
+    ).hexdigest().encode()
+    if cache and os.path.exists(SUBCELLS_PARQUET):
+        try:
+            table = pq.read_table(SUBCELLS_PARQUET)
+        except (OSError, pa.ArrowInvalid) as e:
+            logging.warning(f"Ignoring unreadable subcell cache {SUBCELLS_PARQUET}: {e}")
+            table = None
+        if table is not None and (table.schema.metadata or {}).get(b'fingerprint') == fingerprint:
+            logging.info(f"Reusing {table.num_rows} subcells from {SUBCELLS_PARQUET}.")
+            return (table['site_pos'].to_numpy(),
+                    table['subcell_id'].to_numpy(),
+                    shapely.from_wkb(table['geometry'].to_numpy()))
+
+    # Sites are independent and subdivision is CPU-bound, so spread large
+    # inputs over worker processes; with few sites or a single CPU the pool
+    # startup and result transfer cost more than they save
+    if (os.cpu_count() or 1) > 1 and len(geoms) >= PARALLEL_MIN_SITES:
+        with ProcessPoolExecutor() as ex:
+            subs_per_site = [shapely.from_wkb(w) for w in ex.map(
+                subdivide_site_wkb, wkb, itertools.repeat(CELL_SIZE),
+                chunksize=SUBDIVIDE_CHUNKSIZE)]
+    else:
+        subs_per_site = [subdivide_site(g, CELL_SIZE) for g in geoms]
+    site_pos, subcell_id, cells = [], [], []
+    for pos, subs in enumerate(subs_per_site):
+        logging.info(f"Site {pos+1}: {len(subs)} subcells")
+        site_pos.append(np.full(len(subs), pos))
+        subcell_id.append(np.arange(len(subs)))
+        cells.append(subs)
+    empty = [np.empty(0, dtype=np.int64)]
+    site_pos = np.concatenate(site_pos or empty)
+    subcell_id = np.concatenate(subcell_id or empty)
+    cells = np.concatenate(cells or [np.empty(0, dtype=object)])
+
+    if len(cells):
+        centroids = shapely.centroid(cells)
+        order = np.argsort(hilbert_distance(shapely.get_x(centroids), shapely.get_y(centroids)),
+                           kind='stable')
+        site_pos, subcell_id, cells = site_pos[order], subcell_id[order], cells[order]
+
+    if cache:
+        table = pa.table({
+            'site_pos': site_pos,
+            'subcell_id': subcell_id,
+            'geometry': shapely.to_wkb(cells),
+        }).replace_schema_metadata({'fingerprint': fingerprint})
+        try:
+            os.makedirs(os.path.dirname(SUBCELLS_PARQUET) or ".", exist_ok=True)
+            pq.write_table(table, SUBCELLS_PARQUET, compression='zstd')
+            logging.info(f"Cached {len(cells)} subcells to {SUBCELLS_PARQUET}.")
+        except OSError as e:
+            logging.warning(f"Could not cache subcells to {SUBCELLS_PARQUET}: {e}")
+    return site_pos, subcell_id, cells
 
 # Build NDVI+DEM composite
 def build_combined_image():
@@ -55,72 +208,121 @@ def build_combined_image():
     dem = ee.Image('USGS/SRTMGL1_003').select('elevation')
     return ndvi.addBands(dem)
 
-def export_subregions():
+def reduce_chunk(combined, geojson_feats):
+    """
+    Server-side mean NDVI/elevation for one chunk of subcell GeoJSON features.
+    Cells are UTM boxes on an EPSG:4326 pixel grid, so the mean stays
+    weighted; unweighted, cells holding no pixel centre would come back null.
+    """
+    return combined.reduceRegions(
+        collection=ee.FeatureCollection({'type': 'FeatureCollection', 'features': geojson_feats}),
+        reducer=ee.Reducer.mean(),
+        scale=CELL_SIZE,
+        tileScale=16
+    ).filter(ee.Filter.notNull(['NDVI', 'elevation']))
+
+def chunk_metrics(combined, geojson_feats):
+    """
+    Reduce one chunk and fetch only each subcell's position and metrics,
+    without geometry. Returns (cell, ndvi, elev) arrays.
+    """
+    fc = reduce_chunk(combined, geojson_feats).select(['cell', 'NDVI', 'elevation'], None, False)
+    props = [f['properties'] for f in with_retry(lambda: fetch_features(fc))]
+    return (np.array([p['cell'] for p in props], dtype=np.int64),
+            np.array([p['NDVI'] for p in props], dtype=np.float64),
+            np.array([p['elevation'] for p in props], dtype=np.float64))
+
+def export_subregions(sites=None, export=True, cache_subcells=True):
+    """
+    Score subcells of the candidate sites. `sites` is the list returned by
+    select_possible_site; when omitted, candidates are read from INPUT_CSV.
+    The top K are written to OUTPUT_CSV when export is set, and subdivided
+    cells are cached in SUBCELLS_PARQUET when cache_subcells is set.
+    """
     # 1. Authenticate Earth Engine
     logging.info("Authenticating Earth Engine...")
     authenticate_earth_engine()
 
     # 2. Load candidates
-    logging.info(f"Loading {INPUT_CSV}...")
-    df = pd.read_csv(INPUT_CSV)
-    df['geom'] = df['geometry'].apply(lambda v: shape(json.loads(v)))
+    if sites is None:
+        logging.info(f"Loading {INPUT_CSV}...")
+        # multi-threaded C++ reader, converted to pandas in one step
+        df = pacsv.read_csv(
+            INPUT_CSV, read_options=pacsv.ReadOptions(use_threads=True)
+        ).to_pandas()
+        # parse and construct all geometries in one vectorized GEOS call
+        df['geom'] = shapely.from_geojson(df['geometry'].to_numpy())
+    else:
+        # geometries are already parsed dicts, no JSON round-trip needed
+        df = pd.DataFrame([s['properties'] for s in sites])
+        df['geometry'] = [s['geometry'] for s in sites]
+        df['geom'] = [shape(s['geometry']) for s in sites]
     logging.info(f"Loaded {len(df)} sites.")
 
     # 3. Subdivide all sites
     logging.info("Subdividing sites into cells...")
-    ee_feats = []
-    for idx, row in df.iterrows():
-        subs = subdivide_geometry(row['geom'], CELL_SIZE)
-        logging.info(f"Site {idx+1}: {len(subs)} subcells")
-        for i, sub in enumerate(subs):
-            props = row.drop(['geometry', 'geom']).to_dict()
-            props.update({'site_index': idx, 'subcell_id': i})
-            ee_feats.append(ee.Feature(ee.Geometry(mapping(sub)), props))
-    logging.info(f"Total subcells: {len(ee_feats)}")
+    # Site properties are shared by all of its subcells, so build them once
+    base_props = df.drop(columns=['geometry', 'geom']).to_dict(orient='records')
+    site_index = df.index.tolist()
+    site_pos, subcell_ids, cells = subdivide_sites(df['geom'].to_numpy(), cache=cache_subcells)
+    # Plain GeoJSON dicts; EE objects are only created per chunk below. Each
+    # feature only carries its position in cells, site properties are joined
+    # back for the selected rows
+    geojson_feats = [
+        {'type': 'Feature', 'geometry': orjson.loads(sub_json), 'properties': {'cell': c}}
+        for c, sub_json in enumerate(shapely.to_geojson(cells))
+    ]
+    logging.info(f"Total subcells: {len(geojson_feats)}")
+    if not geojson_feats:
+        logging.error("No subcells to evaluate. Exiting.")
+        return
 
     # 4. Build composite image
     combined = build_combined_image()
 
-    # 5. Bulk reduceRegions
-    logging.info("Running reduceRegions on all subcells...")
-    fc = ee.FeatureCollection(ee_feats)
-    stats_fc = combined.reduceRegions(
-        collection=fc,
-        reducer=ee.Reducer.mean(),
-        scale=CELL_SIZE,
-        tileScale=16
-    )
-
-    # 6. Retrieve stats
-    logging.info("Retrieving stats to DataFrame...")
-    features = stats_fc.getInfo().get('features', [])
-    if not features:
+    # 5. Bulk reduceRegions in concurrent chunks, fetching only the metrics
+    chunks = [geojson_feats[i:i + REDUCE_CHUNK_SIZE]
+              for i in range(0, len(geojson_feats), REDUCE_CHUNK_SIZE)]
+    logging.info(f"Running reduceRegions on all subcells in {len(chunks)} chunks...")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        results = list(ex.map(lambda chunk: chunk_metrics(combined, chunk), chunks))
+    cell, ndvi, elev = (np.concatenate(parts) for parts in zip(*results))
+    dropped = len(geojson_feats) - len(cell)
+    if dropped:
+        logging.warning(f"{dropped} of {len(geojson_feats)} subcells had no NDVI/elevation and were dropped.")
+    if not len(cell):
         logging.error("No features returned from reduceRegions. Exiting.")
         return
-    records = []
-    for f in features:
-        p = f['properties']
-        rec = {k: v for k, v in p.items() if k not in ['NDVI', 'elevation']}
-        rec['NDVI'] = p.get('NDVI') or p.get('NDVI_mean')
-        rec['elevation'] = p.get('elevation') or p.get('elevation_mean')
-        rec['geometry'] = json.dumps(f['geometry'])
-        records.append(rec)
-    stats_df = pd.DataFrame(records)
-    logging.info(f"Stats DataFrame shape: {stats_df.shape}")
-
-    # 7. Compute anomaly score and select top K
-    # Z-score normalize
-    stats_df['ndvi_z'] = (stats_df['NDVI'] - stats_df['NDVI'].mean()) / stats_df['NDVI'].std()
-    stats_df['elev_z'] = (stats_df['elevation'] - stats_df['elevation'].mean()) / stats_df['elevation'].std()
+
+    # 6. Score against the global NDVI/elevation stats of all subcells
+    logging.info(f"Scoring {len(cell)} subcells...")
+    ndvi_z = (ndvi - ndvi.mean()) / ndvi.std(ddof=1)
+    elev_z = (elev - elev.mean()) / elev.std(ddof=1)
     # Composite score: lower NDVI and higher elevation are more anomalous
-    stats_df['score'] = -stats_df['ndvi_z'] + stats_df['elev_z']
-    # Select top K
-    top_df = stats_df.nlargest(TOP_K, 'score')
+    score = elev_z - ndvi_z
+
+    # 7. Select top K and join site properties and geometry for those only
+    top = top_k_indices(score, TOP_K)
+    top_cells = cell[top]
+    pos = site_pos[top_cells]
+    top_df = pd.DataFrame([base_props[p] for p in pos.tolist()])
+    top_df['site_index'] = [site_index[p] for p in pos.tolist()]
+    top_df['subcell_id'] = subcell_ids[top_cells]
+    top_df['NDVI'] = ndvi[top]
+    top_df['elevation'] = elev[top]
+    top_df['ndvi_z'] = ndvi_z[top]
+    top_df['elev_z'] = elev_z[top]
+    top_df['score'] = score[top]
+    top_df['geometry'] = shapely.to_geojson(cells[top_cells])
     logging.info(f"Selected top {len(top_df)} subregions by anomaly score.")
 
     # 8. Export
-    top_df.to_csv(OUTPUT_CSV, index=False)
-    logging.info(f"Exported top {len(top_df)} records to {OUTPUT_CSV}.")
+    if export:
+        # pyarrow's C++ writer avoids per-cell Python formatting of the long
+        # geometry strings
+        pacsv.write_csv(pa.Table.from_pandas(top_df, preserve_index=False), OUTPUT_CSV)
+        export_parquet(top_df, OUTPUT_CSV)
+        logging.info(f"Exported top {len(top_df)} records to {OUTPUT_CSV}.")
 
     return top_df
 
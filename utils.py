@@ -0,0 +1,40 @@
+"""
+utils.py
+
+Helpers shared by the pipeline stages:
+- Top-K selection of scored rows
+- Batched reprojection of shapely geometries
+- Parquet copies of exported CSVs
+"""
+import os
+import logging
+import numpy as np
+import shapely
+
+def top_k_indices(scores, k):
+    """
+    Positions of the k largest non-NaN scores, highest first.
+    Partial selection is O(N + k log k) instead of a full O(N log N) sort.
+    """
+    valid = np.flatnonzero(~np.isnan(scores))
+    k = min(k, len(valid))
+    if k == 0:
+        return valid
+    idx = valid[np.argpartition(-scores[valid], k - 1)[:k]]
+    return idx[np.argsort(-scores[idx], kind='stable')]
+
+def transform_geoms(transformer, geoms):
+    """Apply a pyproj transformer to all coordinates of geoms in one batch."""
+    return shapely.transform(
+        geoms, lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1]))
+    )
+
+def export_parquet(df, csv_path):
+    """
+    Write a Parquet sibling of csv_path. Geometry is stored as WKB bytes,
+    which is more compact than the GeoJSON strings kept in the CSV.
+    """
+    path = os.path.splitext(csv_path)[0] + '.parquet'
+    wkb = shapely.to_wkb(shapely.from_geojson(df['geometry'].to_numpy()))
+    df.assign(geometry=wkb).to_parquet(path, index=False, compression='zstd')
+    logging.info(f"Wrote Parquet copy to {path}.")